@@ -5,46 +5,22 @@
 
 use regex::Regex;
 
-/// Given a git repository and a certain commit. Find the bug fixing commit candidates.
+/// Given the history of a git repository and a certain commit. Find the first `limit` bug fixing
+/// commit candidates.
 pub fn find_bug_fixing_commits(
-    repo: &git2::Repository,
+    graph: &CommitGraph,
     ancestor_str: &str,
+    limit: usize,
 ) -> Result<Vec<git2::Oid>, git2::Error> {
     let ancestor_oid = git2::Oid::from_str(ancestor_str)?;
 
-    let mut descendants = get_descendants(repo, ancestor_oid)?;
-
-    // Need to collect into a Vec, otherwise all the iterators retain the immutable borrow on
-    // descendants for too long.
-    let not_a_fix: Vec<_> = descendants
-        .iter()
-        .enumerate()
-        .filter(|(_ctr, descendant)| match repo.find_commit(**descendant) {
-            Ok(commit) => {
-                let summary = commit.summary().unwrap_or("");
-                !potential_bug_fix_summary(summary)
-            }
-            Err(e) => {
-                eprintln!(
-                    "Failed to find commit for descendant {} ??? This should not happen. Error: {}",
-                    descendant, e
-                );
-                true
-            }
-        })
-        .map(|(ctr, _)| ctr)
-        // Rev is important! If we remove from the front, then the indices that come after are no
-        // longer valid
-        .rev()
-        .collect();
-
-    for idx in not_a_fix {
-        descendants.remove(idx);
-    }
-
-    // _print_oids(&repo, &descendants);
-
-    Ok(descendants)
+    // The descendants are produced lazily, so this stops following the history as soon as enough
+    // candidates have been found instead of first collecting every descendant.
+    Ok(graph
+        .descendants(ancestor_oid)
+        .filter(|descendant| graph.is_potential_bug_fix(*descendant))
+        .take(limit)
+        .collect())
 }
 
 /// Doing this by means of the text in the summary. There are some methods available. Leaning
@@ -91,63 +67,125 @@ fn potential_bug_fix_summary(summary: &str) -> bool {
             Regex::new("(?i)defects?").unwrap(),
             Regex::new("(?i)patch").unwrap(),
         ];
-        static ref RAY_MATCHERS: Vec<Regex> = vec![
-            Regex::new("(?i)error").unwrap(),
-            Regex::new("(?i)bug").unwrap(),
-            Regex::new("(?i)fix").unwrap(),
-            Regex::new("(?i)issue").unwrap(),
-            Regex::new("(?i)mistake").unwrap(),
-            Regex::new("(?i)incorrect").unwrap(),
-            Regex::new("(?i)fault").unwrap(),
-            Regex::new("(?i)defect").unwrap(),
-            Regex::new("(?i)flaw").unwrap(),
-            Regex::new("(?i)type").unwrap(),
-        ];
+        // All keywords in one alternation, so a summary is scanned once rather than once per
+        // keyword.
+        static ref RAY_MATCHER: Regex =
+            Regex::new("(?i)error|bug|fix|issue|mistake|incorrect|fault|defect|flaw|type").unwrap();
     }
-    RAY_MATCHERS.iter().any(|matcher| matcher.is_match(summary))
+    RAY_MATCHER.is_match(summary)
 }
 
-/// Bit convoluted way to get all the descendants of a certain commit. Doing a reversed topological
-/// revwalk with HEAD as the start. Topological ensures all children have been handled before a
-/// parent is handled. Thus reversed means that when you encounter a commit, all its _parents_ have
-/// already been handled. THUS if I keep a set of descendants, starting with just the commit we
-/// care about, then it is a matter of checking the parents of every commit I encounter. If a
-/// parent appears in my descendant list, add it to the descendant list.
+/// The history reachable from HEAD, kept in memory so that the descendants of many commits can be
+/// looked up without walking the repository again for every one of them.
 ///
-/// Not that this does imply the descendants are _not_ sorted by time, but also by topology. Within
-/// one branch, this makes no difference. Across branches there is no time assumption you can make.
-fn get_descendants(
-    repo: &git2::Repository,
-    ancestor: git2::Oid,
-) -> Result<Vec<git2::Oid>, git2::Error> {
-    // We use Oid instead of Commit types. Commit types do not have PartialEq so would not be able
-    // to use contains() further down.
-    let mut descendants: Vec<git2::Oid> = Vec::new();
-    descendants.push(ancestor);
-
-    let mut revwalk = repo.revwalk().unwrap();
-    revwalk.push_head().unwrap();
-    let mut sorting = git2::Sort::TOPOLOGICAL;
-    sorting.insert(git2::Sort::REVERSE);
-    revwalk.set_sorting(sorting).unwrap();
-
-    for oid in revwalk {
-        let oid = oid.unwrap();
-        let commit = repo.find_commit(oid).unwrap();
-        // Clumsy way to get the parents. Commit has a parents() method, but that returns Commit
-        // types while we are collecting Oids.
-        let parent_in_descendants = (0..commit.parent_count())
-            .map(|ctr| commit.parent_id(ctr).unwrap())
-            .any(|parent| descendants.contains(&parent));
-        if parent_in_descendants {
-            descendants.push(oid);
+/// Built from a reversed topological revwalk with HEAD as the start. Topological ensures all
+/// children have been handled before a parent is handled. Thus reversed means that when you
+/// encounter a commit, all its _parents_ have already been handled. That makes it a single pass to
+/// record the children of every commit. The descendants of a commit are then found by following
+/// those children.
+pub struct CommitGraph {
+    /// Commits in the order of the walk, parents before children.
+    commits: Vec<git2::Oid>,
+    /// Index of every commit in `commits`.
+    positions: std::collections::HashMap<git2::Oid, usize>,
+    /// For every commit in `commits`, the indices of its children.
+    children: Vec<Vec<usize>>,
+    /// For every commit in `commits`, whether its summary looks like a bug fix. Most commits are
+    /// a descendant in many lookups, so this is decided once while the commit is at hand anyway.
+    potential_bug_fix: Vec<bool>,
+}
+
+impl CommitGraph {
+    /// Walks the history of the repository once, starting at HEAD.
+    pub fn new(repo: &git2::Repository) -> Result<Self, git2::Error> {
+        let mut revwalk = repo.revwalk()?;
+        revwalk.push_head()?;
+        let mut sorting = git2::Sort::TOPOLOGICAL;
+        sorting.insert(git2::Sort::REVERSE);
+        revwalk.set_sorting(sorting)?;
+
+        let mut graph = CommitGraph {
+            commits: Vec::new(),
+            positions: std::collections::HashMap::new(),
+            children: Vec::new(),
+            potential_bug_fix: Vec::new(),
+        };
+        for oid in revwalk {
+            let oid = oid?;
+            let commit = repo.find_commit(oid)?;
+            let position = graph.commits.len();
+            for parent in commit.parent_ids() {
+                if let Some(&parent_position) = graph.positions.get(&parent) {
+                    graph.children[parent_position].push(position);
+                }
+            }
+            graph.commits.push(oid);
+            graph.positions.insert(oid, position);
+            graph.children.push(Vec::new());
+            graph
+                .potential_bug_fix
+                .push(potential_bug_fix_summary(commit.summary().unwrap_or("")));
         }
+        Ok(graph)
     }
 
-    // The first commit we put in the vector was the ancestor. Remove it now.
-    descendants.remove(0);
+    /// All the descendants of a certain commit, in the order of the walk. Empty if the commit is
+    /// not reachable from HEAD.
+    ///
+    /// Not that this does imply the descendants are _not_ sorted by time, but also by topology.
+    /// Within one branch, this makes no difference. Across branches there is no time assumption
+    /// you can make.
+    pub fn descendants(&self, ancestor: git2::Oid) -> Descendants<'_> {
+        let mut descendants = Descendants {
+            graph: self,
+            seen: std::collections::HashSet::new(),
+            frontier: std::collections::BinaryHeap::new(),
+        };
+        if let Some(&position) = self.positions.get(&ancestor) {
+            descendants.add_children_of(position);
+        }
+        descendants
+    }
+
+    /// Whether the summary of the given commit looks like that of a bug fix. False for commits
+    /// that are not reachable from HEAD.
+    pub fn is_potential_bug_fix(&self, commit: git2::Oid) -> bool {
+        self.positions
+            .get(&commit)
+            .map_or(false, |&position| self.potential_bug_fix[position])
+    }
+}
 
-    Ok(descendants)
+/// Iterator over the descendants of a commit, see [CommitGraph::descendants]. Only follows the
+/// history as far as the descendants that are asked for.
+pub struct Descendants<'a> {
+    graph: &'a CommitGraph,
+    /// Positions of the descendants found so far.
+    seen: std::collections::HashSet<usize>,
+    /// Positions of the descendants found but not yet returned, smallest first. Children always
+    /// come after their parents in the walk, so by the time a position is the smallest one here,
+    /// every descendant before it has already been returned.
+    frontier: std::collections::BinaryHeap<std::cmp::Reverse<usize>>,
+}
+
+impl Descendants<'_> {
+    fn add_children_of(&mut self, position: usize) {
+        for &child in &self.graph.children[position] {
+            if self.seen.insert(child) {
+                self.frontier.push(std::cmp::Reverse(child));
+            }
+        }
+    }
+}
+
+impl Iterator for Descendants<'_> {
+    type Item = git2::Oid;
+
+    fn next(&mut self) -> Option<Self::Item> {
+        let std::cmp::Reverse(position) = self.frontier.pop()?;
+        self.add_children_of(position);
+        Some(self.graph.commits[position])
+    }
 }
 
 fn _print_oids(repo: &git2::Repository, oids: &[git2::Oid]) {
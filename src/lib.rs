@@ -24,3 +24,5 @@ pub mod debugging;
 pub mod find_bug_fix;
 
 mod relative_files;
+
+mod parallel;
@@ -1,6 +1,4 @@
 use clap::{App, Arg, SubCommand};
-use std::fs::File;
-use std::io::prelude::*;
 
 fn main() {
     let matches = App::new("Merge Finder")
@@ -29,6 +27,12 @@ fn main() {
                 .long("all-files")
                 .help("Copy all files present in either O, A, B, or M of the three way merge, not just those present in each and changed")
         )
+        .arg(
+            Arg::with_name("skip-existing")
+                .long("skip-existing")
+                .help("Allow output-folder to be non-empty and skip merges that already have a folder there, e.g. to continue an earlier run. Use the same --all-files setting as that run.")
+                .requires("output-folder")
+        )
         .subcommand(SubCommand::with_name("find-bug-fix")
             .arg(
                 Arg::with_name("commit")
@@ -60,16 +64,14 @@ fn main() {
         if let Some(commitfolder) = find_bug_fix_matches.value_of("commitfolder") {
             three_way_merge_finder::publish::write_bug_fix_files(commitfolder, &repo);
         } else if let Some(commit) = find_bug_fix_matches.value_of("commit") {
-            let commitlist = vec![commit.to_owned()];
-            three_way_merge_finder::publish::print_bug_fix_csv(&repo, &commitlist);
+            three_way_merge_finder::publish::print_bug_fix_csv(&repo, &[commit]);
         } else if let Some(commitfile) = find_bug_fix_matches.value_of("commitlist") {
-            let mut content = String::new();
-            let mut f = File::open(commitfile).unwrap();
-            f.read_to_string(&mut content).unwrap();
+            let content = std::fs::read_to_string(commitfile).unwrap();
+            // Borrow the lines from the file's content rather than copying each of them.
             let commitlist: Vec<_> = content
-                .trim()
-                .split('\n')
-                .map(|line| line.trim().to_owned())
+                .lines()
+                .map(|line| line.trim())
+                .filter(|line| !line.is_empty())
                 .collect();
             three_way_merge_finder::publish::print_bug_fix_csv(&repo, &commitlist);
         } else {
@@ -83,6 +85,7 @@ fn main() {
             .value_of("before")
             .and_then(|before| before.parse().ok());
         let all_files = matches.is_present("all-files");
+        let skip_existing = matches.is_present("skip-existing");
 
         if let Some(output_folder) = output_folder {
             three_way_merge_finder::publish::folder_dump(
@@ -91,6 +94,7 @@ fn main() {
                 revwalk,
                 before,
                 all_files,
+                skip_existing,
             );
         } else {
             three_way_merge_finder::publish::print_csv_of_merges(&repo, revwalk, before);
@@ -1,6 +1,5 @@
 //! This module is used to find three way merges
 
-use std::io::prelude::*;
 /// Walks through commits, looking for those with (exactly) two parents. Collects parents and
 /// the common base.
 pub fn find_merges(
@@ -8,7 +7,7 @@ pub fn find_merges(
     revwalk: git2::Revwalk,
     before: Option<i64>,
 ) -> Vec<ThreeWayMerge> {
-    revwalk
+    let merge_commits: Vec<_> = revwalk
         .map(|oid| {
             repo.find_commit(oid.expect("Failed to get Oid"))
                 .expect("Failed to turn oid into a commit")
@@ -28,27 +27,35 @@ pub fn find_merges(
             let parent2 = commit
                 .parent_id(1)
                 .expect("Failed to get id for second parent.");
-            let base = repo.merge_base(parent1, parent2);
-            match base {
-                Ok(base) => Some(ThreeWayMerge {
-                    o: base,
-                    a: parent1,
-                    b: parent2,
-                    m: commit.id(),
-                }),
-                Err(e) => {
-                    eprintln!(
-                        "Could not find base for the two parent commits of {}. Full error: {}",
-                        commit.id(),
-                        e
-                    );
-                    None
-                }
-            }
+            (commit.id(), parent1, parent2, commit.time().seconds())
         })
-        .filter(|twm| twm.is_some())
-        .map(|twm| twm.unwrap())
-        .collect()
+        .collect();
+
+    // Finding the base of a merge is a walk through history of its own, and it does not depend
+    // on any of the other merges. Have several threads look for them at once.
+    crate::parallel::map_in_parallel(
+        repo,
+        &merge_commits,
+        |repo, &(merge, parent1, parent2, time)| match repo.merge_base(parent1, parent2) {
+            Ok(base) => Some(ThreeWayMerge {
+                o: base,
+                a: parent1,
+                b: parent2,
+                m: merge,
+                time,
+            }),
+            Err(e) => {
+                eprintln!(
+                    "Could not find base for the two parent commits of {}. Full error: {}",
+                    merge, e
+                );
+                None
+            }
+        },
+    )
+    .into_iter()
+    .flatten()
+    .collect()
 }
 
 /// Represents the four parts of a merge by storing the Oid of the merge commit, its parent
@@ -62,13 +69,18 @@ pub struct ThreeWayMerge {
     pub b: git2::Oid,
     /// The merge commit
     pub m: git2::Oid,
+    /// Epoch seconds for the merge commit. Timezone information is discarded. Taken from the merge
+    /// commit while it is at hand in find_merges, so it does not need to be looked up again.
+    pub time: i64,
 }
 
-impl ThreeWayMerge {
-    /// Return a comma separated line of the four commits that form a three way merge. Order:
-    /// O,A,B,M.
-    pub fn to_csv_line(&self) -> String {
-        format!(
+/// Displays as a comma separated line of the four commits that form a three way merge. Order:
+/// O,A,B,M. Writing it out this way formats the commits straight into the output, without
+/// building a String for the line first.
+impl std::fmt::Display for ThreeWayMerge {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        write!(
+            f,
             "{o},{a},{b},{m}",
             o = self.o,
             a = self.a,
@@ -76,13 +88,18 @@ impl ThreeWayMerge {
             m = self.m
         )
     }
+}
 
+impl ThreeWayMerge {
     /// Analyse the merge diffs to decide which files have been modified and are thus
     /// interesting.
     ///
     /// Currently this only considers O to M, which may miss some changed behaviour
     /// disappearing again. TODO
-    pub fn files_to_consider(&self, repo: &git2::Repository) -> std::collections::HashSet<String> {
+    pub fn files_to_consider(
+        &self,
+        repo: &git2::Repository,
+    ) -> std::collections::HashSet<std::path::PathBuf> {
         let mut diffoptions = git2::DiffOptions::new();
         diffoptions.minimal(true).ignore_whitespace(true);
         let o = repo.find_commit(self.o).expect("Failed to find O commit");
@@ -94,23 +111,20 @@ impl ThreeWayMerge {
             .expect("Should be able to diff O to M");
         let mut paths = std::collections::HashSet::new();
         for delta in diff.deltas() {
-            paths.insert(
-                delta
-                    .old_file()
-                    .path()
-                    .unwrap()
-                    .to_str()
-                    .unwrap()
-                    .to_owned(),
-            );
-            paths.insert(
-                delta
-                    .new_file()
-                    .path()
-                    .unwrap()
-                    .to_str()
-                    .unwrap()
-                    .to_owned(),
+            // Old and new path only differ for renames, in which case both are of interest. For
+            // any other delta there is only one path to copy.
+            let new_path = delta.new_file().path();
+            let old_path = delta
+                .old_file()
+                .path()
+                .filter(|&path| Some(path) != new_path);
+            // Kept as paths, there is no need to check they are valid UTF-8 only to turn them back
+            // into paths when writing the files.
+            paths.extend(
+                new_path
+                    .into_iter()
+                    .chain(old_path)
+                    .map(|path| path.to_path_buf()),
             );
         }
         paths
@@ -121,7 +135,7 @@ impl ThreeWayMerge {
     pub fn write_files_to_disk<P: AsRef<std::path::Path>>(
         &self,
         folder: P,
-        changed_files: std::collections::HashSet<String>,
+        changed_files: std::collections::HashSet<std::path::PathBuf>,
         repo: &git2::Repository,
     ) {
         let folder = folder.as_ref();
@@ -135,10 +149,12 @@ impl ThreeWayMerge {
             std::fs::create_dir_all(path).expect("Could not create folder");
         }
 
-        write_files_from_commit_to_disk(folder.join("o"), self.o, repo, &changed_files, "O");
-        write_files_from_commit_to_disk(folder.join("a"), self.a, repo, &changed_files, "A");
-        write_files_from_commit_to_disk(folder.join("b"), self.b, repo, &changed_files, "B");
-        write_files_from_commit_to_disk(folder.join("m"), self.m, repo, &changed_files, "M");
+        // Reuse the paths from above instead of joining them onto the folder a second time.
+        let [o_path, a_path, b_path, m_path] = &paths;
+        write_files_from_commit_to_disk(o_path, self.o, repo, &changed_files, "O");
+        write_files_from_commit_to_disk(a_path, self.a, repo, &changed_files, "A");
+        write_files_from_commit_to_disk(b_path, self.b, repo, &changed_files, "B");
+        write_files_from_commit_to_disk(m_path, self.m, repo, &changed_files, "M");
     }
 
     /// For O, A, B, and M, writes all the files in each version to disk. In other words, a file
@@ -159,72 +175,58 @@ impl ThreeWayMerge {
             std::fs::create_dir_all(path).expect("Could not create folder");
         }
 
-        // Create a list of all files for each version
-        let commit = repo.find_commit(self.o).unwrap();
-        let o_paths = get_all_paths(&commit.tree().unwrap(), "", repo);
-        let commit = repo.find_commit(self.a).unwrap();
-        let a_paths = get_all_paths(&commit.tree().unwrap(), "", repo);
-        let commit = repo.find_commit(self.b).unwrap();
-        let b_paths = get_all_paths(&commit.tree().unwrap(), "", repo);
-        let commit = repo.find_commit(self.m).unwrap();
-        let m_paths = get_all_paths(&commit.tree().unwrap(), "", repo);
-
-        write_files_from_commit_to_disk(folder.join("o"), self.o, repo, &o_paths, "O");
-        write_files_from_commit_to_disk(folder.join("a"), self.a, repo, &a_paths, "A");
-        write_files_from_commit_to_disk(folder.join("b"), self.b, repo, &b_paths, "B");
-        write_files_from_commit_to_disk(folder.join("m"), self.m, repo, &m_paths, "M");
-    }
-
-    /// Returns epoch seconds for the merge commit of the ThreeWayMerge. Timezone information is
-    /// discarded.
-    pub fn time(&self, repo: &git2::Repository) -> i64 {
-        repo.find_commit(self.m)
-            .expect("Failed to find merge commit")
-            .time()
-            .seconds()
+        let [o_path, a_path, b_path, m_path] = &paths;
+        write_all_files_from_commit_to_disk(o_path, self.o, repo);
+        write_all_files_from_commit_to_disk(a_path, self.a, repo);
+        write_all_files_from_commit_to_disk(b_path, self.b, repo);
+        write_all_files_from_commit_to_disk(m_path, self.m, repo);
     }
 }
 
-/// Recursive monstrosity to find all the paths in a commit's tree. Maybe I'm missing something
-/// obvious, but did not see another "easy" way.
-fn get_all_paths(
-    tree: &git2::Tree,
-    current_path: &str,
+/// Writes every file in the given commit into the provided folder. The files are placed in
+/// subfolders mimicking their folders in the commit.
+///
+/// Walks the commit's tree a single time and writes each file as it is encountered, rather than
+/// collecting all paths first and then looking every one of them up in the tree again.
+fn write_all_files_from_commit_to_disk<P: AsRef<std::path::Path>>(
+    folder: P,
+    commit: git2::Oid,
     repo: &git2::Repository,
-) -> std::collections::HashSet<String> {
-    let mut result = std::collections::HashSet::new();
-    for tree_entry in tree.iter() {
-        match tree_entry.kind() {
-            Some(git2::ObjectType::Tree) => {
-                let tree_name = tree_entry.name().unwrap();
-                let new_path = if current_path.is_empty() {
-                    tree_name.to_owned()
-                } else {
-                    format!("{}/{}", current_path, tree_name)
-                };
-                let tree_object = tree_entry.to_object(repo).unwrap();
-                let new_tree = tree_object.as_tree().unwrap();
-                let mut rec_paths = get_all_paths(new_tree, &new_path, repo);
-                // drain instead of iter to move ownership
-                for p in rec_paths.drain() {
-                    result.insert(p);
+) {
+    let folder = folder.as_ref();
+    let commit = repo.find_commit(commit).unwrap();
+    let tree = commit.tree().unwrap();
+    let mut created_folders = std::collections::HashSet::new();
+    tree.walk(git2::TreeWalkMode::PreOrder, |root, tree_entry| {
+        // Trees are descended into by the walk itself, anything else (e.g. submodules) is not a
+        // file we can write.
+        if tree_entry.kind() == Some(git2::ObjectType::Blob) {
+            match tree_entry.name() {
+                Some(name) => {
+                    let file = format!("{}{}", root, name);
+                    let file = std::path::Path::new(&file);
+                    if stays_in_folder(file, &commit) {
+                        write_tree_entry_to_disk(
+                            folder,
+                            file,
+                            tree_entry,
+                            repo,
+                            &commit,
+                            &mut created_folders,
+                        );
+                    }
                 }
-            }
-            Some(git2::ObjectType::Blob) => {
-                let tree_name = tree_entry.name().unwrap();
-                let final_path = if current_path.is_empty() {
-                    tree_name.to_owned()
-                } else {
-                    format!("{}/{}", current_path, tree_name)
-                };
-                result.insert(final_path);
-            }
-            _ => {
-                unreachable!("Should not be able to get here when walking through a commit");
+                None => eprintln!(
+                    "Skipping file with a name that is not valid UTF-8 in {}{:?} of commit {}",
+                    root,
+                    tree_entry.name_bytes(),
+                    commit.id()
+                ),
             }
         }
-    }
-    result
+        git2::TreeWalkResult::Ok
+    })
+    .expect("Failed to walk through the tree of a commit");
 }
 
 /// For a given list of files, locates them in the given commit and writes them into the provided
@@ -233,46 +235,98 @@ pub fn write_files_from_commit_to_disk<P: AsRef<std::path::Path>>(
     folder: P,
     commit: git2::Oid,
     repo: &git2::Repository,
-    changed_files: &std::collections::HashSet<String>,
+    changed_files: &std::collections::HashSet<std::path::PathBuf>,
     commit_description: &str,
 ) {
     let folder = folder.as_ref();
     let commit = repo.find_commit(commit).unwrap();
     let tree = commit.tree().unwrap();
+    let mut created_folders = std::collections::HashSet::new();
     for file in changed_files {
-        let tree_entry = tree.get_path(&std::path::Path::new(&file));
+        if !stays_in_folder(file, &commit) {
+            continue;
+        }
+        let tree_entry = tree.get_path(file);
         if tree_entry.is_err() {
             eprintln!(
                 "File {} not present in {}. Skipping.",
-                &file, commit_description
+                file.display(),
+                commit_description
             );
             continue;
         }
         let tree_entry = tree_entry.unwrap();
-        let obj = match tree_entry.to_object(&repo) {
-            Ok(obj) => obj,
-            Err(err) => {
-                eprintln!(
-                    "ERR: '{}' when looking for file {} in commit {}. File had tree entry id: {}",
-                    err,
-                    file,
-                    commit.id(),
-                    tree_entry.id()
-                );
-                continue;
-            }
-        };
-        let blob = obj.as_blob().unwrap();
-        let fullfilepath = folder.join(file);
-        if let Some(filefolder) = fullfilepath.as_path().parent() {
+        write_tree_entry_to_disk(
+            folder,
+            file,
+            &tree_entry,
+            repo,
+            &commit,
+            &mut created_folders,
+        );
+    }
+}
+
+/// Whether the given path, joined onto a folder, stays inside that folder. Reports the file as
+/// skipped if it does not.
+///
+/// Paths come from the repository and the files it points to, so they cannot be trusted to stay
+/// inside the folder. Something like `..` or a root in there would write files elsewhere. Checked
+/// before the file is looked up in the commit at all.
+fn stays_in_folder(file: &std::path::Path, commit: &git2::Commit) -> bool {
+    let stays_in_folder = file
+        .components()
+        .all(|component| matches!(component, std::path::Component::Normal(_)));
+    if !stays_in_folder {
+        eprintln!(
+            "Skipping file {} in commit {}. Its path would lead outside the output folder.",
+            file.display(),
+            commit.id()
+        );
+    }
+    stays_in_folder
+}
+
+/// Writes the file a tree entry points to into the provided folder, using the given path relative
+/// to that folder. Any missing folders along the way are created. The path is expected to have
+/// passed [stays_in_folder] already.
+///
+/// `created_folders` remembers which folders are known to exist already. Many files share a
+/// folder, so this saves asking the file system to create the same folders over and over.
+fn write_tree_entry_to_disk(
+    folder: &std::path::Path,
+    file: &std::path::Path,
+    tree_entry: &git2::TreeEntry,
+    repo: &git2::Repository,
+    commit: &git2::Commit,
+    created_folders: &mut std::collections::HashSet<std::path::PathBuf>,
+) {
+    let obj = match tree_entry.to_object(&repo) {
+        Ok(obj) => obj,
+        Err(err) => {
+            eprintln!(
+                "ERR: '{}' when looking for file {} in commit {}. File had tree entry id: {}",
+                err,
+                file.display(),
+                commit.id(),
+                tree_entry.id()
+            );
+            return;
+        }
+    };
+    let blob = obj.as_blob().unwrap();
+    let fullfilepath = folder.join(file);
+    if let Some(filefolder) = fullfilepath.as_path().parent() {
+        if !created_folders.contains(filefolder) {
             std::fs::create_dir_all(filefolder).unwrap_or_else(|err| {
                 panic!("Failed to create necessary folders to save file from git to disk. File: {:?}, Err: {}",
                     fullfilepath,
                     err);
             });
+            created_folders.insert(filefolder.to_path_buf());
         }
-        let mut writer = std::fs::File::create(&fullfilepath)
-            .unwrap_or_else(|_| panic!("Failed to open file for writing {:?}", &fullfilepath));
-        writer.write_all(blob.content()).unwrap();
     }
+    // A single call that opens, writes the whole blob, and closes the file.
+    std::fs::write(&fullfilepath, blob.content())
+        .unwrap_or_else(|err| panic!("Failed to write file {:?}, Err: {}", &fullfilepath, err));
 }
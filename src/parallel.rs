@@ -0,0 +1,61 @@
+//! Spreads independent pieces of work over several threads. Used for the parts where every merge
+//! or commit is handled on its own, such as writing out their files.
+
+use std::sync::atomic::{AtomicUsize, Ordering};
+
+/// Calls `f` for every item, spreading the items over one worker thread per available CPU. Items
+/// are handed out one at a time, so a few slow items do not hold up a whole worker's share. The
+/// results are returned in the same order as the items.
+///
+/// A `git2::Repository` cannot be shared between threads, so every worker opens its own and
+/// passes it to `f`.
+pub fn map_in_parallel<T, R, F>(repo: &git2::Repository, items: &[T], f: F) -> Vec<R>
+where
+    T: Sync,
+    R: Send,
+    F: Fn(&git2::Repository, &T) -> R + Sync,
+{
+    let repo_path = repo.path();
+    let workers = std::thread::available_parallelism()
+        .map(|n| n.get())
+        .unwrap_or(1)
+        .min(items.len());
+    let next_item = AtomicUsize::new(0);
+    let mut results: Vec<Option<R>> = std::iter::repeat_with(|| None).take(items.len()).collect();
+    std::thread::scope(|scope| {
+        let mut handles = Vec::with_capacity(workers);
+        for _ in 0..workers {
+            handles.push(scope.spawn(|| {
+                let repo = git2::Repository::open(repo_path)
+                    .expect("Worker thread failed to open the repository");
+                let mut done = Vec::new();
+                loop {
+                    let idx = next_item.fetch_add(1, Ordering::Relaxed);
+                    match items.get(idx) {
+                        Some(item) => done.push((idx, f(&repo, item))),
+                        None => break,
+                    }
+                }
+                done
+            }));
+        }
+        for handle in handles {
+            for (idx, result) in handle.join().expect("Worker thread panicked") {
+                results[idx] = Some(result);
+            }
+        }
+    });
+    results
+        .into_iter()
+        .map(|result| result.expect("Every item is handled by a worker"))
+        .collect()
+}
+
+/// Like [map_in_parallel], for when `f` is only called for its side effects.
+pub fn for_each_in_parallel<T, F>(repo: &git2::Repository, items: &[T], f: F)
+where
+    T: Sync,
+    F: Fn(&git2::Repository, &T) + Sync,
+{
+    map_in_parallel(repo, items, f);
+}
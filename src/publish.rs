@@ -1,48 +1,75 @@
 //! Used to actually get results and print them. Makes use to the [merge](crate::merge) module.
 
+use std::io::prelude::*;
+
+/// How many bug fixing commits are reported (and written out) for a commit.
+const BUG_FIXES_PER_COMMIT: usize = 3;
+
+/// Extension of the folders folder_dump writes a merge into before it is complete.
+const PARTIAL_EXTENSION: &str = "partial";
+
 pub fn print_csv_of_merges(repo: &git2::Repository, revwalk: git2::Revwalk, before: Option<i64>) {
     let merges = super::merge::find_merges(repo, revwalk, before);
-    println!("O,A,B,M");
+    // println! locks stdout for every line and, stdout being line buffered, also writes out every
+    // line separately. Lock it once and buffer the lines instead.
+    let stdout = std::io::stdout();
+    let mut out = std::io::BufWriter::new(stdout.lock());
+    writeln!(out, "O,A,B,M").unwrap();
     for merge in merges {
-        println!("{},{}", merge.to_csv_line(), merge.time(repo));
+        writeln!(out, "{},{}", merge, merge.time).unwrap();
     }
+    out.flush().unwrap();
 }
 
 /// Finds the merges of a given git repository, dumps the changed files for each of them into
 /// the provided folder. Final structure of that folder will be:
 /// folder/mergehash/mergepart/path/to/file
 ///
-/// Folder needs to be empty, may or may not exist.
+/// Folder needs to be empty, may or may not exist. Unless `skip_existing` is set, in which case
+/// merges that already have a folder are left alone and only the missing ones are written. Since
+/// commits do not change, an existing folder already holds what would be written to it. (As long
+/// as it was written with the same `all_files` setting.)
 pub fn folder_dump<P: AsRef<std::path::Path>>(
     folder: P,
     repo: &git2::Repository,
     revwalk: git2::Revwalk,
     before: Option<i64>,
     all_files: bool,
+    skip_existing: bool,
 ) {
     let folder = folder.as_ref();
     // Create folder if needed and check it is empty
     std::fs::create_dir_all(&folder).expect("Could not create output-folder");
     let mut dir_contents = std::fs::read_dir(&folder).expect("Could not read output-folder");
-    if dir_contents.next().is_some() {
+    if !skip_existing && dir_contents.next().is_some() {
         panic!("Specified output-folder is not empty. Aborting.");
     }
 
     let merges = super::merge::find_merges(repo, revwalk, before);
 
-    // Create merge-hash folder and its o, a, b, and m subfolders.
-    if all_files {
-        for merge in merges {
-            let merge_path = folder.join(merge.m.to_string());
-            merge.write_all_files_to_disk(merge_path, &repo);
+    // Create merge-hash folder and its o, a, b, and m subfolders. Merges do not depend on each
+    // other, so they are handled by several threads at once.
+    crate::parallel::for_each_in_parallel(repo, &merges, |repo, merge| {
+        let merge_path = folder.join(merge.m.to_string());
+        if skip_existing && merge_path.exists() {
+            return;
         }
-    } else {
-        for merge in merges {
-            let files = merge.files_to_consider(&repo);
-            let merge_path = folder.join(merge.m.to_string());
-            merge.write_files_to_disk(&merge_path, files, &repo);
+        // Everything is written into a temporary folder that only gets its final name once it is
+        // complete. That way an interrupted run never leaves behind a merge folder that looks
+        // finished, which matters for skip_existing.
+        let partial_path = folder.join(format!("{}.{}", merge.m, PARTIAL_EXTENSION));
+        if partial_path.exists() {
+            std::fs::remove_dir_all(&partial_path)
+                .expect("Could not remove unfinished folder of an earlier run");
         }
-    }
+        if all_files {
+            merge.write_all_files_to_disk(&partial_path, repo);
+        } else {
+            let files = merge.files_to_consider(repo);
+            merge.write_files_to_disk(&partial_path, files, repo);
+        }
+        std::fs::rename(&partial_path, &merge_path).expect("Could not rename finished folder");
+    });
     // TODO? Create a csv file of all merges in the folder
     // TODO? Place detailed diff "overview" in a text file there
 }
@@ -54,26 +81,16 @@ pub fn folder_dump<P: AsRef<std::path::Path>>(
 /// ```
 ///
 /// The latter three may not be present.
-pub fn print_bug_fix_csv(repo: &git2::Repository, broken_commit_list: &[String]) {
+pub fn print_bug_fix_csv<S: AsRef<str>>(repo: &git2::Repository, broken_commit_list: &[S]) {
+    let graph = crate::find_bug_fix::CommitGraph::new(repo).expect("Failed to walk the history");
+    // As in print_csv_of_merges, lock stdout once and buffer the lines.
+    let stdout = std::io::stdout();
+    let mut out = std::io::BufWriter::new(stdout.lock());
     for commit in broken_commit_list {
-        match crate::find_bug_fix::find_bug_fixing_commits(&repo, &commit) {
+        let commit = commit.as_ref();
+        match crate::find_bug_fix::find_bug_fixing_commits(&graph, commit, BUG_FIXES_PER_COMMIT) {
             Ok(descendants) => {
-                println!(
-                    "{},{},{},{}",
-                    commit,
-                    descendants
-                        .get(0)
-                        .map(|oid| oid.to_string())
-                        .unwrap_or_default(),
-                    descendants
-                        .get(1)
-                        .map(|oid| oid.to_string())
-                        .unwrap_or_default(),
-                    descendants
-                        .get(2)
-                        .map(|oid| oid.to_string())
-                        .unwrap_or_default(),
-                );
+                write_bug_fix_csv_line(&mut out, commit, &descendants).unwrap();
             }
             Err(e) => eprintln!(
                 "Failed to find bug fixing commit for {}.\nError: {}",
@@ -81,6 +98,30 @@ pub fn print_bug_fix_csv(repo: &git2::Repository, broken_commit_list: &[String])
             ),
         }
     }
+    out.flush().unwrap();
+}
+
+/// Writes a line of the form
+///
+/// ```text
+/// brokencommit,bugfix1,bugfix2,bugfix3
+/// ```
+///
+/// where the bug fixes are the first three of the given ones, left empty when there are fewer.
+/// The commits are formatted straight into the output instead of each becoming a String first.
+fn write_bug_fix_csv_line<W: Write>(
+    out: &mut W,
+    broken_commit: &str,
+    bug_fixes: &[git2::Oid],
+) -> std::io::Result<()> {
+    write!(out, "{}", broken_commit)?;
+    for ctr in 0..BUG_FIXES_PER_COMMIT {
+        match bug_fixes.get(ctr) {
+            Some(bug_fix) => write!(out, ",{}", bug_fix)?,
+            None => write!(out, ",")?,
+        }
+    }
+    writeln!(out)
 }
 
 /// Expects a folder that is the result of the merge commit search. Thus this folder has several
@@ -103,6 +144,9 @@ pub fn print_bug_fix_csv(repo: &git2::Repository, broken_commit_list: &[String])
 /// existing o, a, b, m folders. Files present in m are used as the basis of what files to write
 /// out from the bug fixing commit.
 ///
+/// Folders ending in `.partial` are left out. Those hold merges that an interrupted
+/// [folder_dump] did not finish writing, their names are not just a commit.
+///
 /// If the folders already exist, the files it finds in this run will be overriden. Nothing else
 /// will be touched.
 pub fn write_bug_fix_files<P>(folder: P, repo: &git2::Repository)
@@ -110,69 +154,67 @@ where
     P: AsRef<std::path::Path>,
 {
     let folder = folder.as_ref();
-    for commit_folder in folder.read_dir().unwrap() {
-        if let Ok(commit_folder) = commit_folder {
-            let commit_folder = commit_folder.path();
-            if let Some(commit_name) = commit_folder.file_name().and_then(|osstr| osstr.to_str()) {
-                match crate::find_bug_fix::find_bug_fixing_commits(&repo, &commit_name) {
-                    Ok(descendants) => {
-                        let files_to_consider: std::collections::HashSet<String> =
-                            crate::relative_files::RelativeFiles::open(&commit_folder.join("m"))
-                                .map(|path| path.to_str().map(|s| s.to_owned()))
-                                .flatten()
-                                .collect();
-                        if let Some(bug_fix_1) = descendants.get(0) {
-                            crate::merge::write_files_from_commit_to_disk(
-                                commit_folder.join("bf1"),
-                                *bug_fix_1,
-                                repo,
-                                &files_to_consider,
-                                "BF1",
-                            );
-                        }
-                        if let Some(bug_fix_2) = descendants.get(1) {
-                            crate::merge::write_files_from_commit_to_disk(
-                                commit_folder.join("bf2"),
-                                *bug_fix_2,
-                                repo,
-                                &files_to_consider,
-                                "BF2",
-                            );
-                        }
-                        if let Some(bug_fix_3) = descendants.get(2) {
-                            crate::merge::write_files_from_commit_to_disk(
-                                commit_folder.join("bf3"),
-                                *bug_fix_3,
-                                repo,
-                                &files_to_consider,
-                                "BF3",
-                            );
-                        }
-
-                        // Output a CSV to STDOUT
-                        println!(
-                            "{},{},{},{}",
-                            commit_name,
-                            descendants
-                                .get(0)
-                                .map(|oid| oid.to_string())
-                                .unwrap_or_default(),
-                            descendants
-                                .get(1)
-                                .map(|oid| oid.to_string())
-                                .unwrap_or_default(),
-                            descendants
-                                .get(2)
-                                .map(|oid| oid.to_string())
-                                .unwrap_or_default(),
+    let graph = crate::find_bug_fix::CommitGraph::new(repo).expect("Failed to walk the history");
+    // flatten gets rid of Err(e) entries
+    let commit_folders: Vec<_> = folder
+        .read_dir()
+        .unwrap()
+        .flatten()
+        .map(|entry| entry.path())
+        .filter(|path| path.extension() != Some(std::ffi::OsStr::new(PARTIAL_EXTENSION)))
+        .collect();
+    // Each commit folder is handled independently of the others, so several threads work through
+    // them at once. They all share the one CommitGraph.
+    crate::parallel::for_each_in_parallel(repo, &commit_folders, |repo, commit_folder| {
+        if let Some(commit_name) = commit_folder.file_name().and_then(|osstr| osstr.to_str()) {
+            match crate::find_bug_fix::find_bug_fixing_commits(
+                &graph,
+                &commit_name,
+                BUG_FIXES_PER_COMMIT,
+            ) {
+                Ok(descendants) => {
+                    let files_to_consider: std::collections::HashSet<_> =
+                        crate::relative_files::RelativeFiles::open(&commit_folder.join("m"))
+                            .collect();
+                    if let Some(bug_fix_1) = descendants.get(0) {
+                        crate::merge::write_files_from_commit_to_disk(
+                            commit_folder.join("bf1"),
+                            *bug_fix_1,
+                            repo,
+                            &files_to_consider,
+                            "BF1",
                         );
                     }
-                    Err(e) => eprintln!(
-                        "Failed to find bug fixing commit for {}.\nError: {}",
-                        commit_name, e
-                    ),
+                    if let Some(bug_fix_2) = descendants.get(1) {
+                        crate::merge::write_files_from_commit_to_disk(
+                            commit_folder.join("bf2"),
+                            *bug_fix_2,
+                            repo,
+                            &files_to_consider,
+                            "BF2",
+                        );
+                    }
+                    if let Some(bug_fix_3) = descendants.get(2) {
+                        crate::merge::write_files_from_commit_to_disk(
+                            commit_folder.join("bf3"),
+                            *bug_fix_3,
+                            repo,
+                            &files_to_consider,
+                            "BF3",
+                        );
+                    }
+
+                    // Output a CSV to STDOUT. Unlike in print_bug_fix_csv this is not buffered, a
+                    // line only follows after its files have been written, so it is shown right
+                    // away. Holding the lock keeps lines from different threads apart.
+                    let stdout = std::io::stdout();
+                    write_bug_fix_csv_line(&mut stdout.lock(), commit_name, &descendants).unwrap();
                 }
+                Err(e) => eprintln!(
+                    "Failed to find bug fixing commit for {}.\nError: {}",
+                    commit_name, e
+                ),
             }
         }
-    }
+    });
 }
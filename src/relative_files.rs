@@ -28,20 +28,29 @@ impl Iterator for RelativeFiles {
     type Item = std::path::PathBuf;
 
     fn next(&mut self) -> Option<Self::Item> {
-        let last_element = self.worklist.pop()?.path();
-        if last_element.is_file() {
-            match last_element.strip_prefix(&self.root) {
-                Ok(last_element) => return Some(last_element.to_path_buf()),
-                Err(e) => eprintln!("Boo boo in RelativeFiles {}", e),
+        loop {
+            let last_element = self.worklist.pop()?;
+            // The file type usually comes along with the directory listing, whereas is_file and
+            // is_dir on the path each ask the file system about it again. Note that symlinks are
+            // not followed this way, but only files and folders get written in the first place.
+            let file_type = match last_element.file_type() {
+                Ok(file_type) => file_type,
+                Err(e) => {
+                    eprintln!("Boo boo in RelativeFiles {}", e);
+                    continue;
+                }
+            };
+            let last_element = last_element.path();
+            if file_type.is_file() {
+                match last_element.strip_prefix(&self.root) {
+                    Ok(last_element) => return Some(last_element.to_path_buf()),
+                    Err(e) => eprintln!("Boo boo in RelativeFiles {}", e),
+                }
+            } else if file_type.is_dir() {
+                if let Ok(read_dir) = last_element.read_dir() {
+                    self.worklist.extend(read_dir.flatten());
+                }
             }
         }
-        if last_element.is_dir() {
-            if let Ok(read_dir) = last_element.read_dir() {
-                let mut contents: Vec<_> = read_dir.flatten().collect();
-                self.worklist.append(&mut contents);
-                return self.next();
-            }
-        }
-        None
     }
 }